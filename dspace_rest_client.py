@@ -4,9 +4,13 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. 
 
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import datetime
 import json
 import logging
+import os
 import requests
 from requests import RequestException
 import sys
@@ -44,6 +48,21 @@ class UpdateItemException(DSpaceRestClientException):
     pass
 
 
+class ExportException(DSpaceRestClientException):
+    pass
+
+
+def _serializable(value):
+    """ Turn attribute values of DSpace objects into something json can dump """
+    if isinstance(value, time.struct_time):
+        return time.strftime('%Y-%m-%d %H:%M:%S', value)
+    if isinstance(value, (AbstractDSpaceObject, Metadata, ResourcePolicy)):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_serializable(v) for v in value]
+    return value
+
+
 class AbstractDSpaceObject:
     """ Empty DSpace blueprint object"""
     def __init__(self, name=None):
@@ -53,6 +72,10 @@ class AbstractDSpaceObject:
         self.type = None
         self.link = None
 
+    def to_dict(self):
+        """ Plain dict of the object's attributes, e.g. for json.dumps """
+        return {k: _serializable(v) for k, v in self.__dict__.items()}
+
 
 class Metadata:
     def __str__(self):
@@ -63,12 +86,26 @@ class Metadata:
         self.value = value
         self.language = lang
 
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def _parse_date(value):
+    """ Policy dates come back as ISO strings or epoch milliseconds, depending on DSpace version """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value / 1000, datetime.timezone.utc).date()
+
+    return datetime.date.fromisoformat(value[:10])
+
 
 class ResourcePolicy:
     def __str__(self):
         return str(['{}: {}'.format(attr, value) for attr, value in self.__dict__.items()])
 
-    def __init__(self):
+    def __init__(self, policy_json=None):
+        self.id = None
         self.action = None
         self.epersonId = None
         self.groupId = None
@@ -80,6 +117,17 @@ class ResourcePolicy:
         self.startDate = None
         self.endDate = None
 
+        if policy_json:
+            for k, v in policy_json.items():
+                # Many policies share the same few actions, types and groups, so keep one copy of each
+                self.__setattr__(k, sys.intern(v) if isinstance(v, str) else v)
+
+            self.startDate = _parse_date(self.startDate)
+            self.endDate = _parse_date(self.endDate)
+
+    def to_dict(self):
+        return {k: v.isoformat() if isinstance(v, datetime.date) else v for k, v in self.__dict__.items()}
+
 
 class Bitstream(AbstractDSpaceObject):
     """
@@ -113,6 +161,9 @@ class Collection(AbstractDSpaceObject):
     def create_item(self, item):
         return Item(item_json=item, collection=self.uuid)
 
+    def get_resource_policies(self, workers=8):
+        return dspace_rest_client.get_resource_policies(collection=self, workers=workers)
+
 
 class Community(AbstractDSpaceObject):
     """
@@ -158,6 +209,9 @@ class Community(AbstractDSpaceObject):
     def get_collections(self):
         return dspace_rest_client._get('communities/{}/collections'.format(self.uuid), Collection)
 
+    def get_resource_policies(self, workers=8):
+        return dspace_rest_client.get_resource_policies(community=self, workers=workers)
+
     def create_collection(self, name):
         # POST / communities / {communityId} / collections - Create new collections in community.You must post Collection.
 
@@ -228,9 +282,18 @@ class Item(AbstractDSpaceObject):
                 self.__setattr__(k, v)
 
             self.lastModified = time.strptime(self.lastModified, "%Y-%m-%d %H:%M:%S.%f")
-            self.archived = bool(item_json['archived'])
-            self.withdrawn = bool(item_json['withdrawn'])
-            self.metadata = self.get_metadata() if dspace_rest_client.load_item_metadata else None
+            # DSpace sends these as the strings "true" and "false"
+            self.archived = item_json['archived'] in (True, 'true')
+            self.withdrawn = item_json['withdrawn'] in (True, 'true')
+
+            # Metadata and bitstreams are inlined when the item was fetched with ?expand=
+            if item_json.get('metadata') is not None:
+                self.metadata = [Metadata(m['key'], m['value'], m['language']) for m in item_json['metadata']]
+            else:
+                self.metadata = self.get_metadata() if dspace_rest_client.load_item_metadata else None
+
+            if item_json.get('bitstreams') is not None:
+                self.bitstreams = [Bitstream(b) for b in item_json['bitstreams']]
 
     def create(self, collection, metadata):
         """
@@ -319,12 +382,7 @@ class Item(AbstractDSpaceObject):
             logging.error('Could not update DSpace item: {}'.format(self.handle))
 
     def get_bitstreams(self):
-        try:
-            response = dspace_rest_client._get('/items/{}/bitstreams'.format(self.uuid), Bitstream)
-        except RequestException:
-            logging.info('Could not get items')
-
-        return response.json()
+        return dspace_rest_client._get('items/{}/bitstreams'.format(self.uuid), Bitstream)
 
     def add_metadata(self, metadata):
         """
@@ -348,6 +406,358 @@ class Item(AbstractDSpaceObject):
         logging.info('Added {} metadata items to item: {}'.format(len(metadata), self.handle))
 
 
+class ResourcePolicyIndex:
+    """
+    Resource policies of a set of bitstreams, indexed so audits can be answered without
+    further calls to the REST API.
+
+    Policies are kept in a single list and looked up by position: per bitstream, and through
+    sorted startDate and endDate columns for date range queries. The date columns are built on
+    the first query after policies were added.
+
+    Queries return (Bitstream, ResourcePolicy) pairs. Bitstreams whose policies could not be
+    fetched are listed in failed.
+    """
+    def __init__(self):
+        self.bitstreams = {}
+        self.item_of = {}
+        self.policies = []
+        self.failed = []
+        self._owners = []
+        self._by_bitstream = {}
+        self._dates = {}
+
+    def __len__(self):
+        return len(self.policies)
+
+    def add(self, bitstream, item_uuid, policies):
+        """
+        Add the policies of a bitstream
+        :param bitstream: Bitstream
+        :param item_uuid: uuid of the owning item
+        :param policies: list of ResourcePolicy
+        """
+        self.bitstreams[bitstream.uuid] = bitstream
+        self.item_of[bitstream.uuid] = item_uuid
+
+        positions = self._by_bitstream.setdefault(bitstream.uuid, [])
+        for policy in policies:
+            positions.append(len(self.policies))
+            self.policies.append(policy)
+            self._owners.append(bitstream.uuid)
+
+        self._dates = {}
+
+    def get_policies(self, bitstream_uuid):
+        return [self.policies[i] for i in self._by_bitstream.get(bitstream_uuid, [])]
+
+    def starting_between(self, start, end):
+        """ Policies whose startDate falls within start and end, inclusive. Datetimes are cut to their date. """
+        return self._between('startDate', start, end)
+
+    def ending_between(self, start, end):
+        """ Policies whose endDate falls within start and end, inclusive. Datetimes are cut to their date. """
+        return self._between('endDate', start, end)
+
+    def starting_within(self, days=30, today=None):
+        """ Policies coming into force in the next days, e.g. embargoes being lifted """
+        today = self._date(today or datetime.date.today())
+        return self.starting_between(today, today + datetime.timedelta(days=days))
+
+    def ending_within(self, days=30, today=None):
+        """ Policies whose endDate passes in the next days """
+        today = self._date(today or datetime.date.today())
+        return self.ending_between(today, today + datetime.timedelta(days=days))
+
+    def embargoed(self, on=None):
+        """ READ policies that do not yet apply on the given date, today by default """
+        on = self._date(on or datetime.date.today())
+        return [(b, p) for b, p in self.starting_between(on + datetime.timedelta(days=1), datetime.date.max)
+                if p.action == 'READ']
+
+    @staticmethod
+    def _date(value):
+        # Policy dates are plain dates, which do not compare with datetimes
+        return value.date() if isinstance(value, datetime.datetime) else value
+
+    def _between(self, attr, start, end):
+        start, end = self._date(start), self._date(end)
+
+        if attr not in self._dates:
+            column = sorted((getattr(p, attr), i) for i, p in enumerate(self.policies) if getattr(p, attr))
+            self._dates[attr] = ([d for d, _ in column], [i for _, i in column])
+
+        dates, positions = self._dates[attr]
+        found = positions[bisect_left(dates, start):bisect_right(dates, end)]
+
+        return [(self.bitstreams[self._owners[i]], self.policies[i]) for i in found]
+
+
+class _JsonlWriter:
+    """ Writes one JSON document per line """
+    def __init__(self, path, columns, append):
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+    def position(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def rewind(path, position):
+        # Truncating a file shorter than the checkpoint would pad it with NUL bytes
+        if not os.path.exists(path) or os.path.getsize(path) < position:
+            raise ExportException('Cannot resume export to {}, it is shorter than its checkpoint.'.format(path))
+
+        os.truncate(path, position)
+
+
+class _CsvWriter(_JsonlWriter):
+    """ Writes flat rows with a header line """
+    def __init__(self, path, columns, append):
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+
+        if not append:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+
+class _ParquetWriter:
+    """
+    Writes each batch as its own part file in the directory at path, so a partial export
+    is always a set of complete, readable files. Requires pyarrow.
+    """
+    def __init__(self, path, columns, append):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportException('Parquet export requires the pyarrow package.')
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.schema = pyarrow.schema([(c, pyarrow.bool_() if c in ('archived', 'withdrawn') else pyarrow.string())
+                                      for c in columns])
+
+        os.makedirs(path, exist_ok=True)
+        if not append:
+            self.rewind(path, 0)
+        self._remove_temporary(path)
+        self.parts = len(self._parts(path))
+
+    def write(self, rows):
+        table = self.pyarrow.Table.from_pylist(rows, schema=self.schema)
+        part = os.path.join(self.path, 'part-{:05d}.parquet'.format(self.parts))
+
+        # Write under a temporary name so an interrupted batch never looks like a finished part
+        self.pyarrow.parquet.write_table(table, part + '.tmp')
+        os.replace(part + '.tmp', part)
+        self.parts += 1
+
+    def position(self):
+        return self.parts
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _parts(path):
+        parts = [f for f in os.listdir(path) if f.startswith('part-') and f.endswith('.parquet')]
+        return sorted(parts, key=lambda f: int(f[len('part-'):-len('.parquet')]))
+
+    @staticmethod
+    def _remove_temporary(path):
+        for f in os.listdir(path):
+            if f.startswith('part-') and f.endswith('.tmp'):
+                os.remove(os.path.join(path, f))
+
+    @staticmethod
+    def rewind(path, position):
+        if not os.path.isdir(path) or len(_ParquetWriter._parts(path)) < position:
+            raise ExportException('Cannot resume export to {}, it has fewer parts than its checkpoint.'.format(path))
+
+        _ParquetWriter._remove_temporary(path)
+        for f in _ParquetWriter._parts(path)[position:]:
+            os.remove(os.path.join(path, f))
+
+
+class ItemExporter:
+    """
+    Streams items from the REST API to a JSONL, CSV or Parquet file.
+
+    Items are fetched a page at a time (metadata and bitstreams inlined with ?expand=) and
+    written out every batch_size items, so memory use is bounded by the batch size rather
+    than the size of the repository.
+
+    After every batch a checkpoint is saved next to the output (path + '.progress'),
+    recording how many items have been written and where the output ended. Calling
+    export(resume=True) drops anything written after the last checkpoint and carries on
+    from there.
+
+    JSONL rows hold every item attribute. CSV and Parquet rows are flat: a few item
+    attributes, one column per entry in metadata_fields and optionally a column of bitstream
+    names, multiple values being joined with '||' as in DSpace's own CSV format.
+    Parquet output is a directory of part files and requires pyarrow.
+    """
+    writers = {
+        'jsonl': _JsonlWriter,
+        'csv': _CsvWriter,
+        'parquet': _ParquetWriter,
+    }
+    item_columns = ['uuid', 'name', 'handle', 'lastModified', 'archived', 'withdrawn']
+    separator = '||'
+
+    def __init__(self, client, path, format='jsonl', metadata_fields=None, include_metadata=False,
+                 include_bitstreams=False, offset=None, batch_size=None, progress=None):
+        """
+        :param client: logged in DSpaceRestClient
+        :param path: file to write, or directory for Parquet
+        :param format: 'jsonl', 'csv' or 'parquet'
+        :param metadata_fields: metadata keys to export as CSV/Parquet columns, e.g. ['dc.title']
+        :param include_metadata: inline item metadata (implied by metadata_fields)
+        :param include_bitstreams: inline bitstream listings
+        :param offset: first item to export
+        :param batch_size: number of items written per batch, defaults to the client's limit
+        :param progress: optional callable, called with the number of items written after each batch
+        """
+        if format not in self.writers:
+            raise ExportException('Unknown export format "{}". Use one of: {}'.format(
+                format, ', '.join(self.writers)))
+
+        self.client = client
+        self.path = path
+        self.format = format
+        self.metadata_fields = list(metadata_fields or [])
+        self.include_metadata = bool(include_metadata or self.metadata_fields)
+        self.include_bitstreams = bool(include_bitstreams)
+        self.offset = client.offset if offset is None else offset
+        self.batch_size = batch_size or client.limit
+        self.progress = progress
+
+        self.columns = self.item_columns + self.metadata_fields
+        if self.include_bitstreams:
+            self.columns = self.columns + ['bitstreams']
+
+        self.checkpoint_path = path + '.progress'
+
+    def export(self, resume=False):
+        """
+        Run the export
+        :param resume: continue from the last checkpoint instead of starting over
+        :return: number of items in the output
+        """
+        writer_type = self.writers[self.format]
+        checkpoint = self._load_checkpoint() if resume else None
+
+        # A checkpoint left by an earlier run no longer describes the output once we start over
+        if not checkpoint and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        if checkpoint:
+            writer_type.rewind(self.path, checkpoint['position'])
+
+            if checkpoint['complete']:
+                logging.info('Export to {} already complete with {} items.'.format(self.path, checkpoint['records']))
+                return checkpoint['records']
+
+            records = checkpoint['records']
+            logging.info('Resuming export to {} after {} items.'.format(self.path, records))
+        else:
+            records = 0
+
+        expand = []
+        if self.include_metadata:
+            expand.append('metadata')
+        if self.include_bitstreams:
+            expand.append('bitstreams')
+
+        writer = writer_type(self.path, self.columns, append=checkpoint is not None)
+        try:
+            batch = []
+            for item in self.client.iter_items(offset=self.offset + records, expand=expand):
+                batch.append(self._row(item))
+
+                if len(batch) >= self.batch_size:
+                    records = self._write_batch(writer, batch, records)
+                    batch = []
+
+            if batch:
+                records = self._write_batch(writer, batch, records)
+
+            self._save_checkpoint(records, writer.position(), complete=True)
+        finally:
+            writer.close()
+
+        logging.info('Exported {} items to {}.'.format(records, self.path))
+
+        return records
+
+    def _write_batch(self, writer, batch, records):
+        writer.write(batch)
+        records += len(batch)
+        self._save_checkpoint(records, writer.position())
+
+        logging.info('Exported {} items to {}.'.format(records, self.path))
+        if self.progress:
+            self.progress(records)
+
+        return records
+
+    def _row(self, item):
+        if self.format == 'jsonl':
+            return item.to_dict()
+
+        row = {c: _serializable(getattr(item, c, None)) for c in self.item_columns}
+
+        for field in self.metadata_fields:
+            values = [m.value for m in item.metadata or [] if m.key == field]
+            row[field] = self.separator.join(values) if values else None
+
+        if self.include_bitstreams:
+            row['bitstreams'] = self.separator.join(b.name for b in getattr(item, 'bitstreams', None) or [])
+
+        return row
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return None
+
+        with open(self.checkpoint_path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+
+        if checkpoint['format'] != self.format or checkpoint['columns'] != self.columns \
+                or checkpoint['offset'] != self.offset:
+            raise ExportException('Cannot resume export to {}, it was started with different options.'.format(
+                self.path))
+
+        return checkpoint
+
+    def _save_checkpoint(self, records, position, complete=False):
+        checkpoint = {
+            'format': self.format,
+            'columns': self.columns,
+            'offset': self.offset,
+            'records': records,
+            'position': position,
+            'complete': complete,
+        }
+
+        # Replace atomically so a crash never leaves a half written checkpoint
+        with open(self.checkpoint_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+
 class DSpaceRestClient:
     def __init__(self, user, password, rest_url, verify_ssl=True, load_item_metadata=False, limit=100, offset=0):
         # Parameters for establishing connection
@@ -523,6 +933,45 @@ class DSpaceRestClient:
         else:
             return 'Could not get {}. \n{}'.format(url, response.content)
 
+    def _iter(self, url, object_type, offset=None, limit=None, expand=None):
+        """
+        Lazily page through supplied DSpace item type, holding one page in memory at a time
+        :param offset:
+        :param limit:
+        :param expand: list of related objects to inline, e.g. ['metadata', 'bitstreams']
+        :return: generator of object_type
+        """
+        if offset is None:
+            offset = self.offset
+        if limit is None:
+            limit = self.limit
+
+        # Inline metadata rather than have Item fetch it one item at a time
+        if object_type is Item and self.load_item_metadata and 'metadata' not in (expand or []):
+            expand = list(expand or []) + ['metadata']
+
+        while True:
+            query = '/{}?offset={}&limit={}'.format(url, offset, limit)
+            if expand:
+                query += '&expand={}'.format(','.join(expand))
+
+            try:
+                response = self._request_get(query)
+            except RequestException as e:
+                raise DSpaceRestClientException('Could not get {}\n{}'.format(url, e))
+
+            if response.status_code != 200:
+                raise DSpaceRestClientException('Could not get {}. Status code: {}'.format(url, response.status_code))
+
+            page = response.json()
+            for obj in page:
+                yield object_type(obj)
+
+            if len(page) < limit:
+                return
+
+            offset += limit
+
     def get_items(self, offset=None, limit=None):
         """
         Get all items in repository
@@ -542,6 +991,107 @@ class DSpaceRestClient:
 
         return self._get('items', Item, offset, limit)
 
+    def iter_items(self, offset=None, limit=None, expand=None):
+        """
+        Iterate over all items in repository without loading them all at once
+        :param offset:
+        :param limit: page size
+        :param expand: list of related objects to inline, e.g. ['metadata', 'bitstreams']
+        :return:
+        """
+        return self._iter('items', Item, offset, limit, expand)
+
+    def export_items(self, path, format='jsonl', metadata_fields=None, include_metadata=False,
+                     include_bitstreams=False, offset=None, batch_size=None, progress=None, resume=False):
+        """
+        Stream all items in repository to a JSONL, CSV or Parquet file, see ItemExporter
+        :param resume: continue a partially written export
+        :return: number of items exported
+        """
+        exporter = ItemExporter(self, path, format=format, metadata_fields=metadata_fields,
+                                include_metadata=include_metadata, include_bitstreams=include_bitstreams,
+                                offset=offset, batch_size=batch_size, progress=progress)
+
+        return exporter.export(resume=resume)
+
+    def get_resource_policies(self, collection=None, community=None, workers=8):
+        """
+        Harvest the resource policies of every bitstream in a collection, a community (including
+        its sub-communities) or, if neither is given, the whole repository.
+        Items are paged through with their bitstreams inlined and the policies of each bitstream
+        are fetched by a pool of workers.
+        :param collection: Collection or collection uuid
+        :param community: Community or community uuid
+        :param workers: number of concurrent requests
+        :return: ResourcePolicyIndex
+        """
+        if collection is not None:
+            items = self._iter('collections/{}/items'.format(getattr(collection, 'uuid', collection)), Item,
+                               expand=['bitstreams'])
+        elif community is not None:
+            items = self._iter_community_items(getattr(community, 'uuid', community))
+        else:
+            items = self.iter_items(expand=['bitstreams'])
+
+        index = ResourcePolicyIndex()
+        seen = set()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for item in items:
+                for bitstream in getattr(item, 'bitstreams', None) or []:
+                    # Items mapped into several collections turn up more than once
+                    if bitstream.uuid not in seen:
+                        seen.add(bitstream.uuid)
+                        batch.append((bitstream, item.uuid))
+
+                # Keep only a few rounds of requests in flight, however large the repository
+                if len(batch) >= workers * 4:
+                    self._add_policies(index, executor, batch)
+                    batch = []
+
+            self._add_policies(index, executor, batch)
+
+        logging.info('Harvested {} resource policies for {} bitstreams.'.format(len(index), len(index.bitstreams)))
+        if index.failed:
+            logging.error('Could not get resource policies for {} bitstreams.'.format(len(index.failed)))
+
+        return index
+
+    def _iter_community_items(self, community_uuid):
+        for collection in self._iter('communities/{}/collections'.format(community_uuid), Collection):
+            yield from self._iter('collections/{}/items'.format(collection.uuid), Item, expand=['bitstreams'])
+
+        for sub_community in self._iter('communities/{}/communities'.format(community_uuid), Community):
+            yield from self._iter_community_items(sub_community.uuid)
+
+    def _add_policies(self, index, executor, batch):
+        for (bitstream, item_uuid), policies in zip(batch, executor.map(self._get_policies, batch)):
+            if policies is None:
+                index.failed.append(bitstream.uuid)
+            else:
+                index.add(bitstream, item_uuid, policies)
+
+    def _get_policies(self, entry):
+        bitstream = entry[0]
+        try:
+            response = self._request_get('/bitstreams/{}/policy'.format(bitstream.uuid))
+        except RequestException as e:
+            logging.error('Could not get resource policies for bitstream: {}\n{}'.format(bitstream.uuid, e))
+            return None
+
+        if response.status_code != 200:
+            logging.error('Could not get resource policies for bitstream: {}. Status code: {}'.format(
+                bitstream.uuid, response.status_code))
+            return None
+
+        # A malformed response or date fails this bitstream only, not the whole harvest
+        try:
+            return [ResourcePolicy(p) for p in response.json()]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error('Could not read resource policies for bitstream: {}\n{}'.format(bitstream.uuid, e))
+            return None
+
     def get_top_communities(self, offset=None, limit=None):
         """
         Get items